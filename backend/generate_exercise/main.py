@@ -4,6 +4,8 @@ import uuid
 import logging
 import re
 import requests
+import functools
+import time
 from google.cloud import firestore
 from google.cloud import secretmanager
 from datetime import datetime
@@ -25,17 +27,30 @@ class DateTimeEncoder(json.JSONEncoder):
         return super(DateTimeEncoder, self).default(obj)
 
 # Secret Manager setup
+@functools.lru_cache(maxsize=1)
+def get_secret_client():
+    """Secret Manager client shared by every access_secret_version call."""
+    return secretmanager.SecretManagerServiceClient()
+
+SECRET_CACHE_TTL_SECONDS = 300
+secret_cache = {}
+
 def access_secret_version(secret_id, version_id="latest"):
     """
-    Access the secret from GCP Secret Manager
+    Access the secret from GCP Secret Manager, reusing a value fetched within the TTL
     """
+    project_id = "pepmvp"  # Replace with your project ID
+    name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
+    cached = secret_cache.get(name)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
     try:
-        client = secretmanager.SecretManagerServiceClient()
-        project_id = "pepmvp"  # Replace with your project ID
-        name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
+        client = get_secret_client()
         response = client.access_secret_version(request={"name": name})
         # Strip whitespace and newlines to avoid issues with API keys
-        return response.payload.data.decode("UTF-8").strip()
+        secret_value = response.payload.data.decode("UTF-8").strip()
+        secret_cache[name] = (secret_value, time.monotonic() + SECRET_CACHE_TTL_SECONDS)
+        return secret_value
     except Exception as e:
         logger.error(f"Error accessing secret '{secret_id}': {str(e)}")
         raise
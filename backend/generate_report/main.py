@@ -8,17 +8,34 @@ from google.cloud import secretmanager
 from google.cloud.firestore_v1._helpers import DatetimeWithNanoseconds
 import uuid
 import re
+import functools
+import time
 
 # Initialize Firebase Admin with default credentials
 firebase_admin.initialize_app()
 db = db = firestore.Client(project='pepmvp', database='pep-mvp')
 
+@functools.lru_cache(maxsize=1)
+def get_secret_client():
+    """Create the Secret Manager client once per instance so warm invocations reuse it."""
+    return secretmanager.SecretManagerServiceClient()
+
+# Secret values by version resource name, mapped to (value, expiry in time.monotonic
+# seconds). Reused for a few minutes; the TTL still picks up rotated keys.
+SECRET_CACHE_TTL_SECONDS = 300
+secret_cache = {}
+
 def get_secret(secret_id):
     """Get secret from Google Cloud Secret Manager."""
-    client = secretmanager.SecretManagerServiceClient()
     name = f"projects/pepmvp/secrets/{secret_id}/versions/latest"
+    cached = secret_cache.get(name)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    client = get_secret_client()
     response = client.access_secret_version(request={"name": name})
-    return response.payload.data.decode("UTF-8")
+    secret_value = response.payload.data.decode("UTF-8")
+    secret_cache[name] = (secret_value, time.monotonic() + SECRET_CACHE_TTL_SECONDS)
+    return secret_value
 
 @functions_framework.http
 def generate_report(request):
@@ -297,8 +314,8 @@ Guidelines for each field:
         try:
             serialized_response = serialize_firestore_data(response_data)
             json_response = json.dumps(serialized_response)
-            print("Final Response:")
-            print(json.dumps(serialized_response, indent=2))
+            # Log the encoded body instead of encoding the response a second time
+            print(f"Final Response: {json_response}")
             return (json_response, 200, headers)
         except Exception as e:
             print(f"Error serializing response: {str(e)}")
@@ -438,8 +455,13 @@ def format_conversation_history(conversation_history):
         formatted.append(f"{role.capitalize()}: {content}")
     return "\n".join(formatted)
 
+# Plain JSON leaves, returned as-is without walking the isinstance checks below
+PASSTHROUGH_TYPES = frozenset((str, int, float, bool, type(None)))
+
 def serialize_firestore_data(data):
     """Helper function to serialize Firestore data for JSON."""
+    if type(data) in PASSTHROUGH_TYPES:
+        return data
     if isinstance(data, dict):
         return {k: serialize_firestore_data(v) for k, v in data.items()}
     elif isinstance(data, list):
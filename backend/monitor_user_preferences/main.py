@@ -22,6 +22,11 @@ except ValueError:
 # Create Firestore client
 db = admin_firestore.Client(project='pepmvp', database='pep-mvp')
 
+# Shared session so warm invocations reuse the keep-alive connection to schedule_notification.
+# No automatic retries: the POST creates a notification and is not safe to repeat.
+http_session = requests.Session()
+http_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=10))
+
 def extract_document_path(cloud_event):
     """Extract the document path from the cloud event data."""
     # Try various methods to extract the document path
@@ -84,9 +89,13 @@ def monitor_user_preferences(cloud_event):
             return
         
         # Debug cloud event properties
-        logger.info(f"Cloud Event Type: {cloud_event.type if hasattr(cloud_event, 'type') else 'unknown'}")
-        logger.info(f"Cloud Event Subject: {cloud_event.subject if hasattr(cloud_event, 'subject') else 'unknown'}")
-        logger.info(f"Cloud Event ID: {cloud_event.id if hasattr(cloud_event, 'id') else 'unknown'}")
+        # One record per event; lazy %-style arguments so nothing is formatted when INFO is disabled
+        logger.info(
+            "Cloud Event type=%s subject=%s id=%s",
+            getattr(cloud_event, 'type', 'unknown'),
+            getattr(cloud_event, 'subject', 'unknown'),
+            getattr(cloud_event, 'id', 'unknown')
+        )
         
         # Extract document path
         doc_path = extract_document_path(cloud_event)
@@ -94,12 +103,12 @@ def monitor_user_preferences(cloud_event):
             logger.error("Could not extract document path from event data")
             return
         
-        logger.info(f"Extracted document path: {doc_path}")
+        logger.info("Extracted document path: %s", doc_path)
         
-        # Extract user_id from the path
-        if '/users/' in doc_path:
-            user_id = doc_path.split('/users/')[1]
-            logger.info(f"Extracted user_id: {user_id}")
+        # Extract user_id from the path in a single scan
+        _, users_sep, user_id = doc_path.partition('/users/')
+        if users_sep:
+            logger.info("Extracted user_id: %s", user_id)
             
             # Process user notification update
             process_user_notification_update(user_id)
@@ -406,7 +415,7 @@ def schedule_notification(user_id, scheduled_time, is_one_time=False, custom_tit
     
     try:
         # Make the HTTP request with a timeout
-        response = requests.post(url, json=payload, timeout=30)
+        response = http_session.post(url, json=payload, timeout=30)
         
         # Process the response
         logger.info(f"Schedule API response status: {response.status_code}")
@@ -1,12 +1,14 @@
 import functions_framework
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core.exceptions import AlreadyExists
 from datetime import datetime, timezone, timedelta
-import json
+import orjson
 import uuid
 from google.cloud import tasks_v2
-import google.auth
 import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -20,6 +22,12 @@ except ValueError:
 
 db = firestore.Client(project='pepmvp', database='pep-mvp')
 
+# Upper bound on the scheduled-notification query so a slow read can't hold the task
+CANCEL_QUERY_TIMEOUT_SECONDS = 10
+
+# Reused across warm invocations to delete cancelled Cloud Tasks concurrently
+io_executor = ThreadPoolExecutor(max_workers=8)
+
 @functions_framework.http
 def schedule_notification(request):
     """
@@ -33,6 +41,15 @@ def schedule_notification(request):
         "custom_title": "string", (optional)
         "custom_body": "string" (optional)
         "force_today": boolean (optional)
+        "cancel_existing": boolean (optional, cancel the user's other scheduled notifications first)
+        "notification_id": "string" (optional, reused by retries so they don't create a second notification)
+        "schedule_id": "string" (optional, dropped unless it matches the user's notification_preferences.schedule_id;
+            with user_snapshot the caller has already checked it)
+        "user_snapshot": { (optional, skips the user document read)
+            "name": "string",
+            "has_fcm_token": boolean,
+            "timezone_offset": float
+        }
     }
     """
     # Enable CORS
@@ -46,57 +63,85 @@ def schedule_notification(request):
     
     headers = {'Access-Control-Allow-Origin': '*'}
     
+    # Cloud Tasks retries every non-2xx response, but a bad request or a user without a
+    # token fails the same way every time, so queued calls acknowledge those with 200
+    rejected_status = 200 if request.headers.get('X-CloudTasks-TaskName') else None
+    
     try:
         # Get request data
-        request_json = request.get_json()
+        request_json = orjson.loads(request.get_data() or b'{}')
         user_id = request_json.get('user_id')
         scheduled_time_str = request_json.get('scheduled_time')
         is_one_time = request_json.get('is_one_time', False)
         custom_title = request_json.get('custom_title', None)
         custom_body = request_json.get('custom_body', None)
         force_today = request_json.get('force_today', False)
+        user_snapshot = request_json.get('user_snapshot')
+        cancel_existing = request_json.get('cancel_existing', False)
+        requested_notification_id = request_json.get('notification_id')
+        schedule_id = request_json.get('schedule_id')
         
         logger.info(f"Received schedule request for user {user_id}: is_one_time={is_one_time}, force_today={force_today}")
         
         # Validate required parameters
         if not user_id or not scheduled_time_str:
             logger.error(f"Missing required parameters: user_id={user_id}, scheduled_time={scheduled_time_str}")
-            return (json.dumps({'error': 'Missing required parameters'}), 400, headers)
+            return (orjson.dumps({'error': 'Missing required parameters'}), rejected_status or 400, headers)
         
-        # Get user data to verify existence and get FCM token
         user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
         
-        if not user_doc.exists:
-            logger.error(f"User not found: {user_id}")
-            return (json.dumps({'error': 'User not found'}), 404, headers)
-        
-        user_data = user_doc.to_dict()
-        
-        # Check for FCM token
-        fcm_token = user_data.get('fcm_token')
-        if not fcm_token:
-            logger.error(f"No FCM token found for user {user_id}")
-            return (json.dumps({'error': 'No FCM token found for user'}), 400, headers)
+        if user_snapshot:
+            # The caller already loaded the user document for this tick, so trust its copy
+            if not user_snapshot.get('has_fcm_token'):
+                logger.error(f"No FCM token found for user {user_id}")
+                return (orjson.dumps({'error': 'No FCM token found for user'}), rejected_status or 400, headers)
+            user_timezone_offset = user_snapshot.get('timezone_offset', 0)
+            username = user_snapshot.get('name', 'User')
+        else:
+            # Get user data to verify existence and get FCM token
+            user_doc = user_ref.get()
+            
+            if not user_doc.exists:
+                logger.error(f"User not found: {user_id}")
+                return (orjson.dumps({'error': 'User not found'}), rejected_status or 404, headers)
+            
+            user_data = user_doc.to_dict()
+            
+            # Queued tasks run in any order; one from an older preference update must not
+            # cancel or overwrite the schedule of a newer one
+            if schedule_id and user_data.get('notification_preferences', {}).get('schedule_id') != schedule_id:
+                logger.info(f"Schedule {schedule_id} for user {user_id} was superseded, not scheduling")
+                return (orjson.dumps({
+                    'status': 'skipped',
+                    'message': 'Superseded by a newer notification preference update'
+                }), 200, headers)
+            
+            # Check for FCM token
+            fcm_token = user_data.get('fcm_token')
+            if not fcm_token:
+                logger.error(f"No FCM token found for user {user_id}")
+                return (orjson.dumps({'error': 'No FCM token found for user'}), rejected_status or 400, headers)
+            
+            # Get timezone offset from user data
+            user_timezone_offset = extract_timezone_offset(user_data)
+            username = user_data.get('name', 'User')
         
-        # Get timezone offset from user data
-        user_timezone_offset = extract_timezone_offset(user_data)
         logger.info(f"User {user_id} timezone offset: UTC{'+' if user_timezone_offset >= 0 else ''}{user_timezone_offset}")
             
-        # Create notification ID for tracking
-        notification_id = str(uuid.uuid4())
+        # Create notification ID for tracking, unless the caller fixed one for its retries
+        notification_id = requested_notification_id or str(uuid.uuid4())
         
         # Parse scheduled time - all incoming times should be in UTC
         try:
             scheduled_time = parse_datetime_to_utc(scheduled_time_str)
             logger.info(f"Parsed scheduled time (UTC): {scheduled_time.isoformat()}")
+            # Stored string form, formatted once for both the notification and the user document
+            scheduled_time_utc_str = scheduled_time.replace(microsecond=0).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
         except (ValueError, TypeError) as e:
             logger.error(f"Invalid scheduled_time format: {scheduled_time_str}. Error: {str(e)}")
-            return (json.dumps({'error': 'Invalid scheduled_time format. Use ISO 8601 format.'}), 400, headers)
+            return (orjson.dumps({'error': 'Invalid scheduled_time format. Use ISO 8601 format.'}), rejected_status or 400, headers)
         
         # Determine notification content
-        username = user_data.get('name', 'User')
-        
         if custom_title and custom_body:
             notification_title = custom_title
             notification_body = custom_body
@@ -109,13 +154,23 @@ def schedule_notification(request):
             notification_body = "It's time for your daily exercise routine. Let's keep that streak going!"
             logger.info(f"Using default notification content for user {user_id}")
         
+        task_client = get_tasks_client()
+        
+        # Cancel the user's other scheduled notifications before the replacement is
+        # created, so the cancellation query can never pick up the new one
+        if cancel_existing:
+            try:
+                cancel_existing_scheduled_notifications(user_id, task_client, keep_notification_id=notification_id)
+            except Exception as e:
+                logger.error(f"Error cancelling existing notifications: {str(e)}")
+        
         # Store notification in Firestore
         notification_data = {
             'id': notification_id,
             'user_id': user_id,
             'type': 'exercise_reminder',
             'scheduled_for': scheduled_time,
-            'scheduled_time_utc': scheduled_time.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            'scheduled_time_utc': scheduled_time_utc_str,
             'status': 'scheduled',
             'created_at': firestore.SERVER_TIMESTAMP,
             'is_one_time': is_one_time,
@@ -126,15 +181,18 @@ def schedule_notification(request):
             'user_timezone_offset': user_timezone_offset,
             'force_today': force_today
         }
+        if schedule_id:
+            notification_data['schedule_id'] = schedule_id
         
-        db.collection('notifications').document(notification_id).set(notification_data)
-        logger.info(f"Created notification document {notification_id} for user {user_id}")
+        # create() rather than set(): a retry must not reset a notification an earlier attempt made
+        try:
+            db.collection('notifications').document(notification_id).create(notification_data)
+            logger.info(f"Created notification document {notification_id} for user {user_id}")
+        except AlreadyExists:
+            logger.info(f"Notification document {notification_id} already exists, reusing it")
         
         # Create Cloud Task to send the notification at the scheduled time
-        credentials, project_id = google.auth.default()
-        task_client = tasks_v2.CloudTasksClient()
-        
-        # Set up Cloud Tasks location and queue
+        # in the Cloud Tasks location and queue below
         parent = task_client.queue_path(
             'pepmvp',  # Your project ID
             'us-central1',  # Choose your region
@@ -156,12 +214,11 @@ def schedule_notification(request):
         # Create the task
         task = {
             'http_request': {
-                'http_method': tasks_v2.HttpMethod.POST,
                 'url': url,
                 'headers': {
                     'Content-Type': 'application/json'
                 },
-                'body': json.dumps(payload).encode()
+                'body': orjson.dumps(payload)
             },
             'schedule_time': {
                 'seconds': scheduled_seconds
@@ -171,13 +228,17 @@ def schedule_notification(request):
         
         logger.info(f"Creating Cloud Task for notification {notification_id} scheduled at {scheduled_time.isoformat()}")
         
-        # Create the Cloud Task
-        response = task_client.create_task(request={'parent': parent, 'task': task})
-        logger.info(f"Created Cloud Task: {response.name}")
+        # Create the Cloud Task; the name is the notification id, so a retry finds it already queued
+        try:
+            task_name = task_client.create_task(request={'parent': parent, 'task': task}).name
+            logger.info(f"Created Cloud Task: {task_name}")
+        except AlreadyExists:
+            task_name = task['name']
+            logger.info(f"Cloud Task already exists: {task_name}")
         
         # Update notification with task information
         db.collection('notifications').document(notification_id).update({
-            'task_name': response.name,
+            'task_name': task_name,
             'updated_at': firestore.SERVER_TIMESTAMP
         })
         
@@ -186,24 +247,77 @@ def schedule_notification(request):
             logger.info(f"Updating user {user_id} with next_notification_time: {scheduled_time.isoformat()}")
             user_ref.update({
                 'next_notification_time': scheduled_time,
-                'next_notification_time_utc': scheduled_time.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                'next_notification_time_utc': scheduled_time_utc_str,
                 'next_notification_utc_hour': scheduled_time.hour,
                 'next_notification_utc_minute': scheduled_time.minute
             })
         
-        return (json.dumps({
+        return (orjson.dumps({
             'status': 'success',
             'message': 'Notification scheduled successfully',
             'notification_id': notification_id,
-            'scheduled_for': serialize_firestore_data(scheduled_time),
-            'task_name': response.name
+            'scheduled_for': scheduled_time.isoformat(),
+            'task_name': task_name
         }), 200, headers)
             
     except Exception as e:
         import traceback
         error_details = traceback.format_exc()
         logger.error(f"Error scheduling notification: {str(e)}\n{error_details}")
-        return (json.dumps({'error': str(e)}), 500, headers)
+        return (orjson.dumps({'error': str(e)}), 500, headers)
+
+@functools.lru_cache(maxsize=1)
+def get_tasks_client():
+    """Create the Cloud Tasks client once per instance so warm invocations reuse its channel."""
+    return tasks_v2.CloudTasksClient()
+
+def cancel_existing_scheduled_notifications(user_id, task_client, keep_notification_id=None):
+    """Cancel any existing scheduled notifications for the user, except keep_notification_id."""
+    logger.info(f"Cancelling existing scheduled notifications for user {user_id}")
+    
+    # Get notifications with status 'scheduled'; only task_name is needed from each
+    notifications = db.collection('notifications') \
+        .where('user_id', '==', user_id) \
+        .where('status', '==', 'scheduled') \
+        .select(['task_name']) \
+        .stream(timeout=CANCEL_QUERY_TIMEOUT_SECONDS)
+    
+    # Mark every notification cancelled through a BulkWriter, which batches, throttles
+    # and retries the writes itself, collecting task names to delete
+    cancelled_count = 0
+    task_names = []
+    bulk_writer = db.bulk_writer()
+    for notif in notifications:
+        # An earlier attempt of this same request may already have created it
+        if notif.id == keep_notification_id:
+            continue
+        bulk_writer.update(notif.reference, {
+            'status': 'cancelled',
+            'updated_at': firestore.SERVER_TIMESTAMP,
+            'cancelled_reason': 'User updated notification preferences'
+        })
+        cancelled_count += 1
+        task_name = notif.to_dict().get('task_name')
+        if task_name:
+            task_names.append(task_name)
+    bulk_writer.close()
+    
+    # Delete the Cloud Tasks concurrently; each is an independent RPC
+    def delete_cloud_task(task_name):
+        try:
+            task_client.delete_task(name=task_name)
+        except Exception as e:
+            return str(e)
+        return None
+    
+    for task_name, error in zip(task_names, io_executor.map(delete_cloud_task, task_names)):
+        if error:
+            logger.error(f"Error deleting Cloud Task {task_name}: {error}")
+        else:
+            logger.info(f"Deleted Cloud Task: {task_name}")
+    
+    logger.info(f"Cancelled {cancelled_count} notifications for user {user_id}")
+    return cancelled_count
 
 def parse_datetime_to_utc(datetime_str):
     """Parse a datetime string to a UTC datetime object."""
@@ -269,17 +383,3 @@ def extract_timezone_offset(user_data):
         timezone_offset = 0
         
     return timezone_offset
-
-# Helper function to serialize Firestore data for JSON
-def serialize_firestore_data(data):
-    """Helper function to serialize Firestore data for JSON."""
-    if isinstance(data, dict):
-        return {k: serialize_firestore_data(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [serialize_firestore_data(item) for item in data]
-    elif hasattr(data, 'datetime'):  # Handle Firestore Timestamp
-        return data.datetime.isoformat()
-    elif isinstance(data, datetime):  # Handle Python datetime objects
-        return data.isoformat()
-    else:
-        return data
\ No newline at end of file
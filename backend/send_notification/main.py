@@ -1,10 +1,13 @@
 import functions_framework
 import firebase_admin
 from firebase_admin import credentials, firestore, messaging
-import json
+from google.api_core.exceptions import AlreadyExists
+import orjson
 from datetime import datetime, timezone, timedelta
-import requests
-import traceback
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import time
+import uuid
 import sys
 import os
 
@@ -16,13 +19,151 @@ from utils.logging_utils import create_logger, log_function_call, log_user_activ
 log = create_logger('send_notification')
 
 # Initialize Firebase Admin if not already initialized
-try:
-    app = firebase_admin.get_app()
-except ValueError:
+if not firebase_admin._apps:
     firebase_admin.initialize_app()
 
+# Fetch the messaging access token at cold start instead of on the first send.
+# The app credential caches it until shortly before expiry, so warm instances
+# reuse one bearer token. A failure here just leaves the fetch to the first send.
+try:
+    firebase_admin.get_app().credential.get_access_token()
+except Exception as e:
+    log.warning("Could not pre-fetch FCM access token", {"error": str(e)})
+
 db = firestore.Client(project='pepmvp', database='pep-mvp')
 
+# Reused across warm invocations to overlap independent Firestore reads
+io_executor = ThreadPoolExecutor(max_workers=4)
+
+# Timestamp fields checked, in order, when a user has no explicit timezone
+TIMEZONE_INDICATOR_FIELDS = ('last_updated', 'last_token_update', 'updated_at', 'next_notification_time')
+
+# Every casing of 'ios', so device detection is a set lookup instead of lower() per call
+IOS_DEVICE_TYPES = frozenset({'ios', 'iOS', 'IOS', 'Ios', 'iOs', 'IoS', 'ioS', 'IOs'})
+
+# Tokens FCM rejected recently on this instance, mapped to when the entry expires
+# (time.monotonic seconds). Lets a reused bad token fail without another FCM round-trip.
+FAILED_TOKEN_TTL_SECONDS = 600
+FAILED_TOKEN_CACHE_SIZE = 10000
+recently_failed_tokens = {}
+
+# Message configs that never vary between sends. The SDK only reads them when
+# serializing a message, so one instance can be shared by every invocation.
+DEFAULT_APNS_CONFIG = messaging.APNSConfig(
+    payload=messaging.APNSPayload(
+        aps=messaging.Aps(
+            sound='default',
+            badge=1,
+            content_available=True
+        )
+    )
+)
+ANDROID_CONFIG = messaging.AndroidConfig(
+    priority='high',
+    notification=messaging.AndroidNotification(
+        priority='high',
+        channel_id='exercise_reminders'
+    )
+)
+
+# Cloud Tasks queue and target for scheduling the next notification, with a short
+# timeout so a stuck enqueue cannot hold the send response
+SCHEDULE_QUEUE_PATH = 'projects/pepmvp/locations/us-central1/queues/notification-queue'
+SCHEDULE_NOTIFICATION_URL = "https://us-central1-pepmvp.cloudfunctions.net/schedule_notification"
+SCHEDULE_TASK_TIMEOUT_SECONDS = 10
+
+# A 'sending' claim older than the function timeout belongs to an invocation that
+# died mid-send, so a retry may take it over
+SENDING_CLAIM_TIMEOUT_SECONDS = 540
+
+# Notification statuses that end the request before any user data is read
+SKIP_STATUS_MESSAGES = {
+    'sent': 'Notification was already sent',
+    'cancelled': 'Notification was cancelled',
+    'sending': 'Notification is already being sent'
+}
+
+@functools.lru_cache(maxsize=1)
+def get_tasks_client():
+    """Create the Cloud Tasks client on first use; only recurring sends need it."""
+    from google.cloud import tasks_v2
+    return tasks_v2.CloudTasksClient()
+
+@functools.lru_cache(maxsize=16)
+def ios_apns_headers(bundle_id):
+    """APNS headers for an iOS bundle; only the topic varies, so each is built once."""
+    return {
+        'apns-push-type': 'alert',
+        'apns-priority': '10',  # High priority
+        'apns-topic': bundle_id
+    }
+
+@firestore.transactional
+def claim_notification(transaction, notification_ref):
+    """
+    Read the notification and mark it as 'sending' in a single transaction.
+
+    The status is only changed when the notification is still sendable (or its
+    'sending' claim is stale), so two deliveries of the same Cloud Task cannot both
+    pass the status check. Returns the snapshot as it was before the claim and
+    whether this invocation now holds the claim.
+    """
+    snapshot = notification_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return snapshot, False
+    notification_data = snapshot.to_dict() or {}
+    status = notification_data.get('status')
+    if status in SKIP_STATUS_MESSAGES and not (status == 'sending' and is_stale_claim(notification_data)):
+        return snapshot, False
+    transaction.update(notification_ref, {
+        'status': 'sending',
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+    return snapshot, True
+
+def is_stale_claim(notification_data):
+    """Check whether a 'sending' claim was taken longer ago than the function can run."""
+    claimed_at = notification_data.get('updated_at')
+    if not isinstance(claimed_at, datetime):
+        return True
+    return (datetime.now(timezone.utc) - claimed_at).total_seconds() > SENDING_CLAIM_TIMEOUT_SECONDS
+
+def release_notification_claim(notification_ref, previous_status):
+    """Hand a claimed notification back to its previous status so a retry can send it."""
+    # A stale claim that was taken over has no earlier status worth restoring
+    notification_ref.update({
+        'status': 'scheduled' if previous_status in (None, 'sending') else previous_status,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+
+def is_recently_failed_token(fcm_token):
+    """Check whether FCM rejected this token on this instance within the TTL."""
+    expires_at = recently_failed_tokens.get(fcm_token)
+    if expires_at is None:
+        return False
+    if expires_at < time.monotonic():
+        recently_failed_tokens.pop(fcm_token, None)
+        return False
+    return True
+
+def remember_failed_token(fcm_token):
+    """Record a token FCM rejected, evicting the oldest entry when the cache is full."""
+    if fcm_token not in recently_failed_tokens and len(recently_failed_tokens) >= FAILED_TOKEN_CACHE_SIZE:
+        recently_failed_tokens.pop(next(iter(recently_failed_tokens)), None)
+    recently_failed_tokens[fcm_token] = time.monotonic() + FAILED_TOKEN_TTL_SECONDS
+
+def mark_notification_failed(notification_ref, error_msg, batch=None):
+    """Record a failed delivery on the notification, optionally as part of a write batch."""
+    failed_update = {
+        'status': 'failed',
+        'error': error_msg,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }
+    if batch is not None:
+        batch.update(notification_ref, failed_update)
+    else:
+        notification_ref.update(failed_update)
+
 @functions_framework.http
 @log_function_call(log)
 def send_notification(request):
@@ -47,89 +188,102 @@ def send_notification(request):
     
     headers = {'Access-Control-Allow-Origin': '*'}
     
+    # Set once this invocation holds the 'sending' claim, so an unexpected error can release it
+    claimed = False
+    notification_ref = None
+    previous_status = None
+    
     try:
         # Get request data
         request_json = request.get_json()
         notification_id = request_json.get('notification_id')
         user_id = request_json.get('user_id')
         
-        # Update logger context with user_id
-        log.set_context(user_id=user_id)
+        # Bind the ids once; every later log entry in this request carries them
+        log.bind(user_id=user_id, notification_id=notification_id)
         
-        log.info("Processing notification request", {
-            "notification_id": notification_id,
-            "user_id": user_id
-        })
+        log.info("Processing notification request")
         
         # Validate required parameters
         if not notification_id or not user_id:
-            log.error("Missing required parameters", {
-                "notification_id": notification_id,
-                "user_id": user_id
-            })
-            return (json.dumps({'error': 'Missing required parameters'}), 400, headers)
+            log.error("Missing required parameters")
+            return (orjson.dumps({'error': 'Missing required parameters'}), 400, headers)
         
-        # Get notification data
         notification_ref = db.collection('notifications').document(notification_id)
-        notification_doc = notification_ref.get()
-        
-        if not notification_doc.exists:
-            log.error("Notification not found", {"notification_id": notification_id})
-            return (json.dumps({'error': 'Notification not found'}), 404, headers)
+        user_ref = db.collection('users').document(user_id)
         
-        notification_data = notification_doc.to_dict()
+        # First deliveries are almost always sendable, so fetch the user while the
+        # notification is being claimed. Cloud Tasks retries are the ones that usually
+        # stop at the status check, so they only read the user after it.
+        first_delivery = request.headers.get('X-CloudTasks-TaskRetryCount', '0') == '0'
+        user_future = io_executor.submit(user_ref.get) if first_delivery else None
         
-        # Check if notification was already sent or cancelled
-        status = notification_data.get('status')
-        if status == 'sent':
-            log.warning("Notification was already sent", {
-                "notification_id": notification_id,
-                "status": status
+        # Get notification data and claim it for this invocation
+        try:
+            notification_doc, claimed = claim_notification(db.transaction(), notification_ref)
+        except ValueError as claim_error:
+            # The transaction kept conflicting: another delivery is claiming it right now
+            log.warning("Could not claim notification", {
+                "error": str(claim_error)
             })
-            return (json.dumps({
+            return (orjson.dumps({
                 'status': 'warning',
-                'message': 'Notification was already sent'
+                'message': SKIP_STATUS_MESSAGES['sending']
             }), 200, headers)
-        elif status == 'cancelled':
-            log.warning("Notification was cancelled", {
-                "notification_id": notification_id,
-                "status": status
-            })
-            return (json.dumps({
+        
+        if not notification_doc.exists:
+            log.error("Notification not found")
+            return (orjson.dumps({'error': 'Notification not found'}), 404, headers)
+        
+        notification_data = notification_doc.to_dict()
+        previous_status = notification_data.get('status')
+        
+        # Check if notification was already sent or cancelled. This must stay ahead of
+        # the sequential user read so Cloud Tasks retries of finished notifications abort
+        # without paying for a second document fetch.
+        if not claimed:
+            status = previous_status
+            message = SKIP_STATUS_MESSAGES[status]
+            log.warning(message, {"status": status})
+            return (orjson.dumps({
                 'status': 'warning',
-                'message': 'Notification was cancelled'
+                'message': message
             }), 200, headers)
-        
-        # Get user data
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
+
+        # Get user data (only once the notification is known to be sendable)
+        user_doc = user_future.result() if user_future else user_ref.get()
         
         if not user_doc.exists:
-            log.error("User not found", {"user_id": user_id})
-            notification_ref.update({
-                'status': 'failed',
-                'error': 'User not found',
-                'updated_at': firestore.SERVER_TIMESTAMP
-            })
-            return (json.dumps({'error': 'User not found'}), 404, headers)
+            log.error("User not found")
+            mark_notification_failed(notification_ref, 'User not found')
+            return (orjson.dumps({'error': 'User not found'}), 404, headers)
         
         user_data = user_doc.to_dict()
-        log.info("Retrieved user data", {
-            "user_id": user_id, 
+        log.debug("Retrieved user data", {
             "has_fcm_token": 'fcm_token' in user_data,
-            "user_fields": list(user_data.keys())
+            "field_count": len(user_data)
         })
         
-        # Check for FCM token
-        fcm_token = user_data.get('fcm_token')
-        if not fcm_token:
-            log.error("No FCM token found for user", {"user_id": user_id})
+        # A notification from a daily chain that a later preference update replaced is dropped
+        schedule_id = notification_data.get('schedule_id')
+        if schedule_id and user_data.get('notification_preferences', {}).get('schedule_id') != schedule_id:
+            log.warning("Notification superseded by a newer preference update", {"schedule_id": schedule_id})
             notification_ref.update({
-                'status': 'failed',
-                'error': 'No FCM token for user',
+                'status': 'cancelled',
+                'cancelled_reason': 'Superseded by a newer notification preference update',
                 'updated_at': firestore.SERVER_TIMESTAMP
             })
-            return (json.dumps({'error': 'No FCM token for user'}), 400, headers)
+            return (orjson.dumps({
+                'status': 'warning',
+                'message': SKIP_STATUS_MESSAGES['cancelled']
+            }), 200, headers)
+        
+        # Check for FCM token
+        fcm_token = user_data.get('fcm_token')
+        if not fcm_token:
+            log.error("No FCM token found for user")
+            mark_notification_failed(notification_ref, 'No FCM token for user')
+            return (orjson.dumps({'error': 'No FCM token for user'}), 400, headers)
         
         # Get notification content - prioritize next_day_notification content
         username = user_data.get('name', user_data.get('user_name', user_data.get('display_name', 'there')))
@@ -140,14 +294,14 @@ def send_notification(request):
         if next_day_data and 'title' in next_day_data and 'body' in next_day_data:
             notification_title = next_day_data.get('title')
             notification_body = next_day_data.get('body')
-            log.info("Using next_day_notification content", {"source": "next_day_notification"})
+            log.debug("Using next_day_notification content", {"source": "next_day_notification"})
         else:
             # Fallback to content saved with the notification
             notification_title = stored_content.get('title', f"Time for Exercise, {username}!")
             notification_body = stored_content.get('body', "It's time for your daily exercise routine. Let's keep that streak going!")
-            log.info("Using stored notification content", {"source": "notification"})
+            log.debug("Using stored notification content", {"source": "notification"})
         
-        log.info("Prepared notification content", {
+        log.debug("Prepared notification content", {
             "title": notification_title,
             "body_preview": notification_body[:30] + "..." if len(notification_body) > 30 else notification_body
         })
@@ -156,13 +310,13 @@ def send_notification(request):
         device_type = user_data.get('device_type', 'unknown')
         bundle_id = user_data.get('app_bundle_id', 'yanffyy.xyz.MVP')
         
-        log.info("Device information", {
+        log.debug("Device information", {
             "device_type": device_type,
             "bundle_id": bundle_id
         })
         
         # APNS configuration for iOS
-        if device_type and device_type.lower() == 'ios':
+        if device_type in IOS_DEVICE_TYPES:
             apns_config = messaging.APNSConfig(
                 payload=messaging.APNSPayload(
                     aps=messaging.Aps(
@@ -177,25 +331,13 @@ def send_notification(request):
                         category='EXERCISE_REMINDER'
                     )
                 ),
-                headers={
-                    'apns-push-type': 'alert',
-                    'apns-priority': '10',  # High priority
-                    'apns-topic': bundle_id
-                }
+                headers=ios_apns_headers(bundle_id)
             )
-            log.info("Created iOS APNS config")
+            log.debug("Created iOS APNS config")
         else:
             # Default configuration for other devices
-            apns_config = messaging.APNSConfig(
-                payload=messaging.APNSPayload(
-                    aps=messaging.Aps(
-                        sound='default',
-                        badge=1,
-                        content_available=True
-                    )
-                )
-            )
-            log.info("Created default APNS config for non-iOS device")
+            apns_config = DEFAULT_APNS_CONFIG
+            log.debug("Using default APNS config for non-iOS device")
         
         # Compose FCM message
         message = messaging.Message(
@@ -209,30 +351,91 @@ def send_notification(request):
                 'type': notification_data.get('type', 'exercise_reminder')
             },
             token=fcm_token,
-            android=messaging.AndroidConfig(
-                priority='high',
-                notification=messaging.AndroidNotification(
-                    priority='high',
-                    channel_id='exercise_reminders'
-                )
-            ),
+            android=ANDROID_CONFIG,
             apns=apns_config
         )
         
         # Send the notification
         try:
-            log.info("Sending FCM notification")
+            if is_recently_failed_token(fcm_token):
+                raise messaging.UnregisteredError('FCM token was rejected recently, not sending again')
+            log.debug("Sending FCM notification")
             response = messaging.send(message)
             log.info("FCM notification sent successfully", {"message_id": response})
             
-            # Log user activity
-            log_user_activity(user_id, "notification_sent", {
+            # Log user activity on the pool so its write overlaps the status commit below
+            activity_future = io_executor.submit(log_user_activity, user_id, "notification_sent", {
                 "notification_id": notification_id,
                 "title": notification_title
             })
             
-            # Update notification status
-            notification_ref.update({
+            # Collect the post-send writes so they go out in a single commit
+            batch = db.batch()
+            schedule_payload = None
+            
+            # If this is a recurring notification, schedule the next one
+            is_one_time = notification_data.get('is_one_time', False)
+            if not is_one_time:
+                log.debug("Processing recurring notification")
+                # Get notification preferences and decide up front whether there is a next notification at all
+                notification_prefs = user_data.get('notification_preferences', {})
+                is_enabled = notification_prefs.get('is_enabled', False)
+                frequency = notification_prefs.get('frequency')
+                hour = notification_prefs.get('hour')
+                minute = notification_prefs.get('minute')
+                
+                if is_enabled and frequency == 'daily' and hour is not None and minute is not None:
+                    # Get user's timezone offset using the standardized function
+                    user_timezone_offset = extract_timezone_offset(user_data)
+                    log.debug("User timezone information", {"timezone_offset": user_timezone_offset})
+                    
+                    # Calculate next notification time
+                    next_time = calculate_next_notification_time(
+                        hour=hour,
+                        minute=minute,
+                        user_timezone_offset=user_timezone_offset
+                    )
+                    
+                    # Format once and reuse for both the stored string and the schedule payload
+                    next_time_utc_str = next_time.replace(microsecond=0).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+                    log.debug("Calculated next notification time", {
+                        "next_time": next_time_utc_str
+                    })
+                    
+                    # Written with the 'sent' status so the user shows the next slot even
+                    # if queueing the scheduling task below fails
+                    batch.update(user_ref, {
+                        'next_notification_time': next_time,
+                        'next_notification_time_utc': next_time_utc_str,
+                        'next_notification_utc_hour': next_time.hour,
+                        'next_notification_utc_minute': next_time.minute
+                    })
+                    
+                    schedule_payload = {
+                        'user_id': user_id,
+                        # Derived from this notification, so a retried scheduling call
+                        # reuses the same id instead of creating a second reminder
+                        'notification_id': str(uuid.uuid5(uuid.NAMESPACE_URL, f"pepmvp/notifications/{notification_id}/next")),
+                        'scheduled_time': next_time_utc_str,
+                        'is_one_time': False,
+                        'schedule_id': schedule_id,
+                        # Fields schedule_notification would otherwise re-read from the user document
+                        'user_snapshot': {
+                            'name': user_data.get('name', 'User'),
+                            'has_fcm_token': True,
+                            'timezone_offset': user_timezone_offset
+                        }
+                    }
+                else:
+                    log.warning("Recurring notification not scheduled", {
+                        "is_enabled": is_enabled,
+                        "frequency": frequency,
+                        "has_time": hour is not None and minute is not None
+                    })
+            else:
+                log.info("Notification was one-time, not scheduling next one")
+            
+            batch.update(notification_ref, {
                 'status': 'sent',
                 'sent_at': firestore.SERVER_TIMESTAMP,
                 'message_id': response,
@@ -241,88 +444,44 @@ def send_notification(request):
                     'body': notification_body
                 }
             })
+            batch.commit()
             
-            # If this is a recurring notification, schedule the next one
-            is_one_time = notification_data.get('is_one_time', False)
-            if not is_one_time:
-                log.info("Processing recurring notification")
-                # Get notification preferences
-                notification_prefs = user_data.get('notification_preferences', {})
-                if notification_prefs.get('is_enabled', False) and notification_prefs.get('frequency') == 'daily':
-                    hour = notification_prefs.get('hour')
-                    minute = notification_prefs.get('minute')
+            # Schedule the next notification by enqueueing a Cloud Task that calls
+            # schedule_notification, rather than waiting for it to finish here
+            if schedule_payload:
+                try:
+                    log.info("Scheduling next notification", {
+                        "scheduled_time": schedule_payload['scheduled_time']
+                    })
                     
-                    if hour is not None and minute is not None:
-                        # Get user's timezone offset using the standardized function
-                        user_timezone_offset = extract_timezone_offset(user_data)
-                        log.info("User timezone information", {
-                            "user_id": user_id,
-                            "timezone_offset": user_timezone_offset
-                        })
-                        
-                        # Calculate next notification time
-                        next_time = calculate_next_notification_time(
-                            hour=hour,
-                            minute=minute,
-                            user_timezone_offset=user_timezone_offset
-                        )
-                        
-                        log.info("Calculated next notification time", {
-                            "next_time": next_time.isoformat()
-                        })
-                        
-                        # Update user's next notification time
-                        user_ref.update({
-                            'next_notification_time': next_time,
-                            'next_notification_time_utc': next_time.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-                            'next_notification_utc_hour': next_time.hour,
-                            'next_notification_utc_minute': next_time.minute
-                        })
-                        
-                        # Schedule the next notification through a separate HTTP call
-                        try:
-                            # Prepare the request payload
-                            payload = {
-                                'user_id': user_id,
-                                'scheduled_time': next_time.isoformat(),
-                                'is_one_time': False
+                    schedule_task = get_tasks_client().create_task(request={
+                        'parent': SCHEDULE_QUEUE_PATH,
+                        'task': {
+                            # Named after this notification so a retried send can't queue it twice
+                            'name': f"{SCHEDULE_QUEUE_PATH}/tasks/schedule-next-{notification_id}",
+                            'http_request': {
+                                'url': SCHEDULE_NOTIFICATION_URL,
+                                'headers': {'Content-Type': 'application/json'},
+                                'body': orjson.dumps(schedule_payload)
                             }
-                            
-                            # URL of the schedule_notification Cloud Function
-                            url = f"https://us-central1-pepmvp.cloudfunctions.net/schedule_notification"
-                            
-                            # Log the payload
-                            log.info("Scheduling next notification with payload", {
-                                "payload": json.dumps(payload)
-                            })
-                            
-                            # Make the HTTP request
-                            schedule_response = requests.post(url, json=payload, timeout=30)
-                            
-                            if schedule_response.status_code == 200:
-                                response_data = schedule_response.json()
-                                log.info("Successfully scheduled next notification", {
-                                    "response_data": response_data
-                                })
-                            else:
-                                log.error("Failed to schedule next notification", {
-                                    "status_code": schedule_response.status_code,
-                                    "response_text": schedule_response.text
-                                })
-                        except Exception as schedule_error:
-                            log.error("Error scheduling next notification", {
-                                "error": str(schedule_error),
-                                "traceback": traceback.format_exc()
-                            })
-                else:
-                    log.warning("Recurring notification not scheduled", {
-                        "is_enabled": notification_prefs.get('is_enabled'),
-                        "frequency": notification_prefs.get('frequency')
+                        }
+                    }, timeout=SCHEDULE_TASK_TIMEOUT_SECONDS)
+                    log.info("Queued next notification scheduling", {
+                        "task_name": schedule_task.name
+                    })
+                except AlreadyExists:
+                    log.info("Next notification scheduling was already queued")
+                except Exception as schedule_error:
+                    import traceback
+                    log.error("Error scheduling next notification", {
+                        "error": str(schedule_error),
+                        "traceback": traceback.format_exc()
                     })
-            else:
-                log.info("Notification was one-time, not scheduling next one")
             
-            return (json.dumps({
+            # Finish the activity write before responding; instances lose CPU once the response is sent
+            activity_future.result()
+            
+            return (orjson.dumps({
                 'status': 'success',
                 'message': 'Notification sent successfully',
                 'fcm_message_id': response
@@ -331,23 +490,21 @@ def send_notification(request):
         except (messaging.UnregisteredError, messaging.SenderIdMismatchError) as token_error:
             # Handle invalid token errors
             error_msg = str(token_error)
+            remember_failed_token(fcm_token)
             log.error("FCM Token error", {
                 "error": error_msg
             })
             
-            user_ref.update({
+            # Clear the token and fail the notification in one commit
+            batch = db.batch()
+            batch.update(user_ref, {
                 'fcm_token': firestore.DELETE_FIELD,
                 'notification_status': 'token_expired'
             })
+            mark_notification_failed(notification_ref, error_msg, batch=batch)
+            batch.commit()
             
-            # Update notification record
-            notification_ref.update({
-                'status': 'failed',
-                'error': error_msg,
-                'updated_at': firestore.SERVER_TIMESTAMP
-            })
-            
-            return (json.dumps({
+            return (orjson.dumps({
                 'status': 'error',
                 'message': f'FCM Token Error: {error_msg}'
             }), 500, headers)
@@ -360,19 +517,16 @@ def send_notification(request):
             })
             
             # Update notification record
-            notification_ref.update({
-                'status': 'failed',
-                'error': error_msg,
-                'updated_at': firestore.SERVER_TIMESTAMP
-            })
+            mark_notification_failed(notification_ref, error_msg)
             
-            return (json.dumps({
+            return (orjson.dumps({
                 'status': 'error',
                 'message': error_msg
             }), 500, headers)
             
         except Exception as fcm_error:
             # Handle all other FCM errors
+            import traceback
             error_msg = str(fcm_error)
             log.error("FCM general error", {
                 "error": error_msg
@@ -382,52 +536,53 @@ def send_notification(request):
             })
             
             # Update notification record
-            notification_ref.update({
-                'status': 'failed',
-                'error': error_msg,
-                'updated_at': firestore.SERVER_TIMESTAMP
-            })
+            mark_notification_failed(notification_ref, error_msg)
             
-            return (json.dumps({
+            return (orjson.dumps({
                 'status': 'error',
                 'message': f'Notification Error: {error_msg}'
             }), 500, headers)
             
     except Exception as e:
+        import traceback
         error_details = traceback.format_exc()
         log.error("Unexpected error", {
             "error": str(e),
             "traceback": error_details
         })
-        return (json.dumps({'error': str(e)}), 500, headers)
+        # Without this the notification would stay 'sending' and every retry would skip it
+        if claimed:
+            try:
+                release_notification_claim(notification_ref, previous_status)
+            except Exception as release_error:
+                log.error("Could not release notification claim", {
+                    "error": str(release_error)
+                })
+        return (orjson.dumps({'error': str(e)}), 500, headers)
+
+@functools.lru_cache(maxsize=1024)
+def parse_timezone_string(timezone_value):
+    """Parse a stored timezone string such as '-7' or '"5.5"' into hours (cached, offsets repeat across users)."""
+    # Remove quotes if present
+    return float(timezone_value.strip('"\''))
 
 def extract_timezone_offset(user_data):
     """Extract timezone offset from user data consistently."""
     # First, check for the explicit timezone field (which appears in your user document)
-    log.info("🕒 extract_timezone_offset: Checking for timezone field")
-    log.info("User data", {
-        "user_data": user_data
-    })
-    if 'timezone' in user_data:
+    timezone_value = user_data.get('timezone')
+    if timezone_value is not None:
         try:
-            timezone_value = user_data.get('timezone')
             if isinstance(timezone_value, str):
-                # Remove quotes if present
-                timezone_value = timezone_value.strip('"\'')
-            timezone_offset = float(timezone_value)
-            log.info("Extracted timezone offset", {
-                "timezone_offset": timezone_offset
-            })
-            return timezone_offset
+                return parse_timezone_string(timezone_value)
+            return float(timezone_value)
         except (ValueError, TypeError) as e:
             log.warning("Could not convert timezone value", {
-                "timezone_value": user_data.get('timezone'),
+                "timezone_value": timezone_value,
                 "error": str(e)
             })
     
     # Next, try to get from notification_preferences
-    notification_prefs = user_data.get('notification_preferences', {})
-    timezone_offset = notification_prefs.get('timezone_offset')
+    timezone_offset = user_data.get('notification_preferences', {}).get('timezone_offset')
     if timezone_offset is not None:
         return timezone_offset
     
@@ -437,25 +592,25 @@ def extract_timezone_offset(user_data):
         return timezone_offset
     
     # If still not found, try to extract from timestamps
-    if timezone_offset is None:
-        timezone_indicators = ['last_updated', 'last_token_update', 'updated_at', 'next_notification_time']
-        for field in timezone_indicators:
-            if field in user_data and user_data[field]:
-                timestamp_value = user_data[field]
-                # Check if the timestamp has timezone information
-                if hasattr(timestamp_value, 'tzinfo') and timestamp_value.tzinfo:
-                    timezone_offset = timestamp_value.utcoffset().total_seconds() / 3600
-                    log.info("Extracted timezone offset", {
-                        "timezone_offset": timezone_offset
-                    })
-                    break
+    for field in TIMEZONE_INDICATOR_FIELDS:
+        timestamp_value = user_data.get(field)
+        # Check if the timestamp has timezone information
+        if timestamp_value and getattr(timestamp_value, 'tzinfo', None):
+            timezone_offset = timestamp_value.utcoffset().total_seconds() / 3600
+            log.debug("Extracted timezone offset", {
+                "field": field,
+                "timezone_offset": timezone_offset
+            })
+            return timezone_offset
     
     # Default to UTC if still not found
-    if timezone_offset is None:
-        log.warning("Could not determine user timezone, defaulting to UTC")
-        timezone_offset = 0
-        
-    return timezone_offset
+    log.warning("Could not determine user timezone, defaulting to UTC")
+    return 0
+
+@functools.lru_cache(maxsize=4096)
+def utc_time_of_day(hour, minute, user_timezone_offset):
+    """Time after UTC midnight at which a local hour:minute falls for a fixed UTC offset (in hours)."""
+    return timedelta(seconds=((hour * 60 + minute) * 60 - user_timezone_offset * 3600) % 86400)
 
 def calculate_next_notification_time(hour, minute, user_timezone_offset, current_time=None):
     """
@@ -471,46 +626,21 @@ def calculate_next_notification_time(hour, minute, user_timezone_offset, current
         next_time: The next notification time as a datetime object in UTC
     """
     # Use provided time or current UTC time
-    now = current_time or datetime.now(timezone.utc)
-    log.info("Current time (UTC)", {
-        "current_time": now.isoformat()
-    })
+    now = (current_time or datetime.now(timezone.utc)).astimezone(timezone.utc)
     
-    # First, convert the current UTC time to the user's local time
-    user_local_time = now.astimezone(timezone(timedelta(hours=user_timezone_offset)))
-    log.info("Current time in user's timezone (UTC{'+' if user_timezone_offset >= 0 else ''}{user_timezone_offset})", {
-        "user_local_time": user_local_time.isoformat()
-    })
+    # Today's UTC occurrence of the user's local hour:minute; the offset from
+    # midnight only depends on (hour, minute, offset), so it is cached
+    utc_midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    target_time_utc = utc_midnight + utc_time_of_day(hour, minute, user_timezone_offset)
     
-    # Create a target time in user's local timezone for today
-    user_target_time = user_local_time.replace(hour=hour, minute=minute, second=0, microsecond=0)
-    log.info("Target time in user's timezone", {
-        "user_target_time": user_target_time.isoformat()
-    })
+    # If that moment has already passed, the next one is a day later
+    if target_time_utc <= now:
+        target_time_utc += timedelta(days=1)
     
-    # If target time has passed in user's timezone, add a day
-    if user_target_time <= user_local_time:
-        user_target_time += timedelta(days=1)
-        log.info("Target time already passed in user's timezone, scheduling for tomorrow", {
-            "user_target_time": user_target_time.isoformat()
-        })
-        
-    # Convert the final time back to UTC for storage and scheduling
-    target_time_utc = user_target_time.astimezone(timezone.utc)
-    log.info("Final notification time (UTC)", {
+    log.debug("Final notification time (UTC)", {
+        "current_time": now.isoformat(),
+        "timezone_offset": user_timezone_offset,
         "target_time_utc": target_time_utc.isoformat()
     })
     
     return target_time_utc
-
-# Helper function to serialize Firestore data for JSON
-def serialize_firestore_data(data):
-    """Helper function to serialize Firestore data for JSON."""
-    if isinstance(data, dict):
-        return {k: serialize_firestore_data(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [serialize_firestore_data(item) for item in data]
-    elif hasattr(data, 'datetime'):  # Handle Firestore Timestamp
-        return data.datetime.isoformat()
-    else:
-        return data
\ No newline at end of file
@@ -8,11 +8,15 @@ import requests
 import logging
 
 # Initialize Firebase Admin if not already initialized
-try:
-    app = firebase_admin.get_app()
-except ValueError:
+if not firebase_admin._apps:
     firebase_admin.initialize_app()
 
+# APNS headers are the same for every test send; the SDK only reads them when serializing
+TEST_APNS_HEADERS = {
+    'apns-push-type': 'alert',
+    'apns-priority': '10'
+}
+
 @https_fn.on_call()
 def send_test_notification(req: https_fn.CallableRequest) -> dict:
     """
@@ -35,28 +39,28 @@ def send_test_notification(req: https_fn.CallableRequest) -> dict:
         # Log the test attempt
         print(f"Attempting to send test notification to token: {data.get('token')[:10]}...")
         
+        title = data.get("title", "Test Notification")
+        body = data.get("body", "This is a test notification from Firebase")
+        
         # Create message with improved APNS configuration for iOS
         message = messaging.Message(
             notification=messaging.Notification(
-                title=data.get("title", "Test Notification"),
-                body=data.get("body", "This is a test notification from Firebase")
+                title=title,
+                body=body
             ),
             token=data.get("token"),
             apns=messaging.APNSConfig(
                 payload=messaging.APNSPayload(
                     aps=messaging.Aps(
                         alert=messaging.ApsAlert(
-                            title=data.get("title", "Test Notification"),
-                            body=data.get("body", "This is a test notification from Firebase")
+                            title=title,
+                            body=body
                         ),
                         badge=1,
                         sound="default"
                     )
                 ),
-                headers={
-                    'apns-push-type': 'alert',
-                    'apns-priority': '10'
-                }
+                headers=TEST_APNS_HEADERS
             )
         )
         
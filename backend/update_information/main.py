@@ -1,25 +1,63 @@
 import functions_framework
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core.exceptions import AlreadyExists, NotFound
 from datetime import datetime, timedelta, timezone
-import json
-import uuid
-import requests
+import orjson
+import functools
+import hashlib
 import logging
-import traceback
+import re
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Initialize Firebase Admin if not already initialized
-try:
-    app = firebase_admin.get_app()
-except ValueError:
+if not firebase_admin._apps:
     firebase_admin.initialize_app()
 
 db = firestore.Client(project='pepmvp', database='pep-mvp')
 
+# User fields read for timezone detection; the rest of the document is never needed
+TIMEZONE_FIELD_PATHS = [
+    'timezone',
+    'notification_preferences.timezone_offset',
+    'notification_timezone_offset',
+    'last_updated',
+    'last_token_update',
+    'updated_at',
+    'next_notification_time'
+]
+
+# Fixed UTC format for stored and scheduled times; notification times have no seconds
+UTC_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+# Source recorded on every field this function writes
+UPDATED_BY = 'elevenlabs_agent'
+
+# Fixed part of the notification_preferences written when a notification time is set
+NOTIFICATION_PREFERENCE_DEFAULTS = {
+    'is_enabled': True,
+    'frequency': 'daily',  # Default to daily
+    'updated_by': UPDATED_BY,
+    'last_scheduled_utc': None
+}
+
+# 'HH:MM' (hour and minute may be one digit), validated and split in a single match
+TIME_PATTERN = re.compile(r'([01]?\d|2[0-3]):([0-5]?\d)')
+
+# Cloud Tasks queue and target for handing scheduling off to schedule_notification
+SCHEDULE_QUEUE_PATH = 'projects/pepmvp/locations/us-central1/queues/notification-queue'
+SCHEDULE_NOTIFICATION_URL = "https://us-central1-pepmvp.cloudfunctions.net/schedule_notification"
+SCHEDULE_TASK_TIMEOUT_SECONDS = 10
+
+@functools.lru_cache(maxsize=1)
+def get_tasks_client():
+    """Create the Cloud Tasks client on first use; only rescheduling requests need it."""
+    from google.cloud import tasks_v2
+    return tasks_v2.CloudTasksClient()
+
 @functions_framework.http
 def update_information(request):
     """
@@ -36,6 +74,9 @@ def update_information(request):
         "force_today": boolean (optional)
         "set_last_analysis_timestamp": boolean (optional, default false)
     }
+    
+    An optional Idempotency-Key header makes retries of the same request reuse
+    its activity entry and scheduling task instead of creating new ones.
     """
 
     # Enable CORS
@@ -43,33 +84,37 @@ def update_information(request):
         headers = {
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'POST',
-            'Access-Control-Allow-Headers': 'Content-Type'
+            'Access-Control-Allow-Headers': 'Content-Type, Idempotency-Key',
+            'Access-Control-Max-Age': '3600'
         }
         return ('', 204, headers)
     
     headers = {'Access-Control-Allow-Origin': '*'}
     
     try:
-        # Get request data
-        request_json = request.get_json()
+        # Get request data; anything but a JSON object is rejected before any field is read
+        try:
+            request_json = orjson.loads(request.get_data() or b'{}')
+        except orjson.JSONDecodeError:
+            request_json = None
+        if not isinstance(request_json, dict):
+            logger.error("Request body is not a JSON object")
+            return (orjson.dumps({'error': 'Request body must be a JSON object'}), 400, headers)
         user_id = request_json.get('user_id')
         
         logger.info(f"Received update_information request for user {user_id}")
         
         if not user_id:
             logger.error("Missing user_id in request")
-            return (json.dumps({'error': 'Missing user_id'}), 400, headers)
+            return (orjson.dumps({'error': 'Missing user_id'}), 400, headers)
         
-        # Check if user exists
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
+        # Stable per-request id when the caller supplied an idempotency key
+        idempotency_key = request.headers.get('Idempotency-Key')
+        request_key = hashlib.sha256(f"{user_id}:{idempotency_key}".encode()).hexdigest() if idempotency_key else None
         
-        if not user_doc.exists:
-            logger.error(f"User {user_id} not found")
-            return (json.dumps({'error': 'User not found'}), 404, headers)
-        
-        # Get user data for timezone information
-        user_data = user_doc.to_dict()
+        # The user is only read when the stored timezone is needed; otherwise a
+        # missing user is reported by the update itself
+        user_ref = db.collection('users').document(user_id)
         
         # Get update data
         notification_time = request_json.get('notification_time')
@@ -80,12 +125,26 @@ def update_information(request):
         force_today = request_json.get('force_today', False)
         set_last_analysis_timestamp = request_json.get('set_last_analysis_timestamp', False)
         
+        # Nothing in the request can produce an update, so skip the user read entirely
+        if not (notification_time or next_notification_time_input or user_goals or exercise_routine
+                or set_last_analysis_timestamp or user_timezone_input is not None):
+            logger.info(f"No data to update for user {user_id}.")
+            return (orjson.dumps({'status': 'no_op', 'message': 'No information provided to update'}), 200, headers)
+        
         # Prepare update data
         update_data = {}
         notification_updated = False
         
+        # Id of the notification this request will schedule, fixed before the update is
+        # written so the new preferences can name it (see schedule_id below)
+        scheduled_notification_id = None
+        if notification_time or next_notification_time_input:
+            scheduled_notification_id = request_key or db.collection('notifications').document().id
+        
         # Determine user timezone from input or existing data
         user_timezone_offset_hours = None
+        # Offset written back when the user has no stored notification_timezone_offset yet
+        timezone_backfill = {}
         if user_timezone_input is not None:
             try:
                 # Client provided timezone as hours offset (e.g., -7 for UTC-7)
@@ -99,95 +158,101 @@ def update_information(request):
         
         # If timezone not provided, extract from existing data
         if user_timezone_offset_hours is None:
-            user_timezone_offset_hours = extract_timezone_offset(user_data)
+            # Only the fields extract_timezone_offset reads are fetched
+            user_doc = user_ref.get(field_paths=TIMEZONE_FIELD_PATHS)
+            if not user_doc.exists:
+                logger.error(f"User {user_id} not found")
+                return (orjson.dumps({'error': 'User not found'}), 404, headers)
+            user_data = user_doc.to_dict()
+            found_offset = extract_timezone_offset(user_data, default=None)
+            user_timezone_offset_hours = found_offset if found_offset is not None else 0
             logger.info(f"Extracted timezone offset: UTC{'+' if user_timezone_offset_hours >= 0 else ''}{user_timezone_offset_hours}")
+            # Store a derived offset so later requests find it without scanning timestamps;
+            # the UTC fallback is a guess and is never stored
+            if found_offset is not None and user_data.get('notification_timezone_offset') is None:
+                timezone_backfill['notification_timezone_offset'] = found_offset
         
         # Create the timezone object
-        user_tz = timezone(timedelta(hours=user_timezone_offset_hours))
+        user_tz = timezone_for_offset(user_timezone_offset_hours)
         
         # Update notification preferences if provided
         if notification_time:
-            try:
-                # Parse notification time (expected format: "HH:MM")
-                hour, minute = map(int, notification_time.split(':'))
-                if 0 <= hour <= 23 and 0 <= minute <= 59:
-                    logger.info(f"Setting notification preferences to {hour:02d}:{minute:02d} in user's local timezone")
-                    
-                    update_data['notification_preferences'] = {
-                        'is_enabled': True,
-                        'frequency': 'daily',  # Default to daily
-                        'hour': hour,          # Local hour (what user sees)
-                        'minute': minute,      # Local minute
-                        'timezone_offset': user_timezone_offset_hours,
-                        'updated_at': firestore.SERVER_TIMESTAMP,
-                        'updated_by': 'elevenlabs_agent',
-                        'last_scheduled_utc': None
-                    }
-                    notification_updated = True
-                else:
-                    logger.error(f"Invalid hour/minute range in notification_time: {notification_time}")
-                    return (json.dumps({'error': 'Invalid notification time format (range)'}), 400, headers)
-            except (ValueError, AttributeError):
-                logger.error(f"Failed to parse notification_time: {notification_time}")
-                return (json.dumps({'error': 'Invalid notification time format (parsing)'}), 400, headers)
+            # Parse and validate the time (expected format: "HH:MM") in one match
+            parsed_time = parse_hour_minute(notification_time)
+            if parsed_time:
+                hour, minute = parsed_time
+                logger.info(f"Setting notification preferences to {hour:02d}:{minute:02d} in user's local timezone")
+                
+                update_data['notification_preferences'] = {
+                    **NOTIFICATION_PREFERENCE_DEFAULTS,
+                    'hour': hour,          # Local hour (what user sees)
+                    'minute': minute,      # Local minute
+                    'timezone_offset': user_timezone_offset_hours,
+                    'updated_at': firestore.SERVER_TIMESTAMP,
+                    # Identifies the daily chain started by this update; schedule_notification
+                    # and send_notification drop queued work from any older chain
+                    'schedule_id': scheduled_notification_id
+                }
+                notification_updated = True
+            else:
+                logger.error(f"Invalid notification_time: {notification_time}")
+                return (orjson.dumps({'error': 'Invalid notification time format'}), 400, headers)
         
         # Update next notification time if provided
         if next_notification_time_input:
-            try:
-                hour, minute = map(int, next_notification_time_input.split(':'))
-                if 0 <= hour <= 23 and 0 <= minute <= 59:
-                    logger.info(f"Processing one-time notification request for {hour:02d}:{minute:02d} in user's local timezone")
-                    
-                    # Get current time IN USER'S TIMEZONE
-                    now_user_tz = datetime.now(user_tz)
-                    logger.info(f"Current time in user timezone: {now_user_tz.isoformat()}")
+            # Parse and validate the time (expected format: "HH:MM") in one match
+            parsed_time = parse_hour_minute(next_notification_time_input)
+            if parsed_time:
+                hour, minute = parsed_time
+                logger.info(f"Processing one-time notification request for {hour:02d}:{minute:02d} in user's local timezone")
+                
+                # Get current time IN USER'S TIMEZONE
+                now_user_tz = datetime.now(user_tz)
+                logger.info(f"Current time in user timezone: {now_user_tz.isoformat()}")
 
-                    # Create target time for TODAY in user's timezone
-                    target_time_today = now_user_tz.replace(hour=hour, minute=minute, second=0, microsecond=0)
-                    logger.info(f"Target time today in user timezone: {target_time_today.isoformat()}")
+                # Create target time for TODAY in user's timezone
+                target_time_today = now_user_tz.replace(hour=hour, minute=minute, second=0, microsecond=0)
+                logger.info(f"Target time today in user timezone: {target_time_today.isoformat()}")
 
-                    # If the target time has already passed today and force_today is False, schedule for tomorrow
-                    if target_time_today <= now_user_tz and not force_today:
-                        target_datetime = target_time_today + timedelta(days=1)
-                        logger.info(f"Target time already passed today in user TZ. Scheduling for tomorrow.")
+                # If the target time has already passed today and force_today is False, schedule for tomorrow
+                if target_time_today <= now_user_tz and not force_today:
+                    target_datetime = target_time_today + timedelta(days=1)
+                    logger.info(f"Target time already passed today in user TZ. Scheduling for tomorrow.")
+                else:
+                    target_datetime = target_time_today
+                    if target_time_today <= now_user_tz and force_today:
+                        logger.info(f"Target time already passed today, but force_today=True. Scheduling for today anyway.")
                     else:
-                        target_datetime = target_time_today
-                        if target_time_today <= now_user_tz and force_today:
-                            logger.info(f"Target time already passed today, but force_today=True. Scheduling for today anyway.")
-                        else:
-                            logger.info(f"Target time is later today in user TZ. Scheduling for today.")
+                        logger.info(f"Target time is later today in user TZ. Scheduling for today.")
 
-                    # Convert to UTC for storage
-                    target_time_utc = target_datetime.astimezone(timezone.utc)
-                    logger.info(f"Converted target time to UTC: {target_time_utc.isoformat()}")
-                    
-                    # Store time as UTC in database
-                    update_data['next_notification_time'] = target_time_utc
-                    update_data['next_notification_time_utc'] = target_time_utc.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-                    update_data['next_notification_utc_hour'] = target_time_utc.hour
-                    update_data['next_notification_utc_minute'] = target_time_utc.minute
-                    update_data['next_notification_local_hour'] = hour
-                    update_data['next_notification_local_minute'] = minute
-                    update_data['notification_timezone_offset'] = user_timezone_offset_hours
-                    update_data['next_notification_time_manual_override'] = True
-                    
-                    # Track if this was forced to be today
-                    if force_today:
-                        update_data['force_today'] = True
-                        logger.info("Setting force_today flag for this notification")
+                # Convert to UTC for storage
+                target_time_utc = target_datetime.astimezone(timezone.utc)
+                logger.info(f"Converted target time to UTC: {target_time_utc.isoformat()}")
+                
+                # Store time as UTC in database
+                update_data['next_notification_time'] = target_time_utc
+                update_data['next_notification_time_utc'] = target_time_utc.strftime(UTC_TIME_FORMAT)
+                update_data['next_notification_utc_hour'] = target_time_utc.hour
+                update_data['next_notification_utc_minute'] = target_time_utc.minute
+                update_data['next_notification_local_hour'] = hour
+                update_data['next_notification_local_minute'] = minute
+                update_data['notification_timezone_offset'] = user_timezone_offset_hours
+                update_data['next_notification_time_manual_override'] = True
+                
+                # Track if this was forced to be today
+                if force_today:
+                    update_data['force_today'] = True
+                    logger.info("Setting force_today flag for this notification")
 
-                else:
-                    logger.error(f"Invalid hour/minute range in next_notification_time: {next_notification_time_input}")
-                    return (json.dumps({'error': 'Invalid next notification time format (range)'}), 400, headers)
-            except (ValueError, AttributeError):
-                logger.error(f"Failed to parse next_notification_time: {next_notification_time_input}")
-                return (json.dumps({'error': 'Invalid next notification time format (parsing)'}), 400, headers)
+            else:
+                logger.error(f"Invalid next_notification_time: {next_notification_time_input}")
+                return (orjson.dumps({'error': 'Invalid next notification time format'}), 400, headers)
         
         # Update user goals if provided
         if user_goals:
             update_data['user_goals'] = user_goals
             update_data['goal_updated_at'] = firestore.SERVER_TIMESTAMP
-            update_data['goal_updated_by'] = 'elevenlabs_agent'
+            update_data['goal_updated_by'] = UPDATED_BY
             logger.info(f"Updating user goals for user {user_id}")
         
         # Update exercise routine if provided
@@ -195,12 +260,12 @@ def update_information(request):
             # Validate exercise routine format - should be a string
             if not isinstance(exercise_routine, str):
                 logger.error("Exercise routine must be a string")
-                return (json.dumps({'error': 'Exercise routine must be a string describing your regular physical activities'}), 400, headers)
+                return (orjson.dumps({'error': 'Exercise routine must be a string describing your regular physical activities'}), 400, headers)
             
             # Update the exercise routine
             update_data['exercise_routine'] = exercise_routine
             update_data['routine_updated_at'] = firestore.SERVER_TIMESTAMP
-            update_data['routine_updated_by'] = 'elevenlabs_agent'
+            update_data['routine_updated_by'] = UPDATED_BY
             logger.info(f"Updating exercise routine for user {user_id}")
         
         # ---- Add logic for analysis timestamp ----
@@ -211,41 +276,14 @@ def update_information(request):
         
         # If no updates provided (check *after* potentially adding the timestamp)
         if not update_data:
-            # It's okay if *only* the timestamp was requested, so remove the old error check
-            # logger.warning("No update data provided")
-            # return (json.dumps({'error': 'No update data provided'}), 400, headers)
-             logger.info(f"No profile fields provided to update for user {user_id}, potentially only timestamp requested.")
-             # Allow proceeding if only the timestamp was set
-
-        # Update user document only if there's something to update
-        if update_data:
-            logger.info(f"Updating Firestore for user {user_id} with data: {update_data}")
-            user_ref.update(update_data) # Use update instead of set with merge if we know doc exists
-        else:
              logger.info(f"No data to update for user {user_id}.")
-             # If only the timestamp was requested and set, it would have been in update_data
              # This path might be hit if the request was empty or only had set_last_analysis_timestamp: false
-             return (json.dumps({'status': 'no_op', 'message': 'No information provided to update'}), 200, headers)
+             return (orjson.dumps({'status': 'no_op', 'message': 'No information provided to update'}), 200, headers)
 
-        # Create an activity log entry (consider if timestamp-only updates need logging)
-        if update_data and any(k != 'last_analysis_request_timestamp' for k in update_data): # Log if more than just timestamp changed
-             activity_id = str(uuid.uuid4())
-             activity_data = {
-                 'id': activity_id,
-                 'user_id': user_id,
-                 'type': 'profile_update',
-                 'updated_fields': list(update_data.keys()),
-                 'updated_at': firestore.SERVER_TIMESTAMP,
-                 'updated_by': 'elevenlabs_agent' # Or identify source if needed
-             }
-             db.collection('activities').document(activity_id).set(activity_data)
-             logger.info(f"Created activity log entry {activity_id} for user {user_id}")
-
-        # If notification time was updated, schedule a notification
-        scheduled_task_id = None
-        
+        # If notification time was updated, compute the next notification up front
+        # so it is written together with the rest of the profile update
+        user_update = {**timezone_backfill, **update_data} if timezone_backfill else update_data
         if notification_updated:
-            logger.info("Notification preferences were updated, scheduling next notification")
             # Use the standardized function to calculate next notification time
             next_time = calculate_next_notification_time(
                 hour=update_data['notification_preferences']['hour'],
@@ -253,94 +291,134 @@ def update_information(request):
                 user_timezone_offset=user_timezone_offset_hours
             )
             
-            logger.info(f"Calculated next notification time (UTC): {next_time.isoformat()}")
+            # Formatted once; the same string is stored and sent to schedule_notification
+            next_time_utc_str = next_time.strftime(UTC_TIME_FORMAT)
+            logger.info(f"Calculated next notification time (UTC): {next_time_utc_str}")
             
-            # Update the user's next_notification_time
-            user_ref.update({
+            user_update = {
+                **user_update,
                 'next_notification_time': next_time,
-                'next_notification_time_utc': next_time.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                'next_notification_time_utc': next_time_utc_str,
                 'next_notification_utc_hour': next_time.hour,
                 'next_notification_utc_minute': next_time.minute,
                 'notification_timezone_offset': user_timezone_offset_hours
-            })
-            
+            }
 
-            # Cancel any existing scheduled notifications
-            try:
-                logger.info(f"Cancelling existing scheduled notifications for user {user_id}")
-                cancel_existing_scheduled_notifications(user_id)
-            except Exception as e:
-                logger.error(f"Error cancelling existing notifications: {str(e)}")
-                logger.error(traceback.format_exc())
+        # Write the user update and its activity log entry in a single commit
+        batch = db.batch()
+        logger.debug("Updating Firestore for user %s with data: %s", user_id, user_update)
+        batch.update(user_ref, user_update) # Use update instead of set with merge if we know doc exists
 
-            
+        # Create an activity log entry (consider if timestamp-only updates need logging)
+        activity_id = None
+        if any(k != 'last_analysis_request_timestamp' for k in update_data): # Log if more than just timestamp changed
+             # A retried request overwrites its own entry rather than adding another
+             activities = db.collection('activities')
+             activity_ref = activities.document(request_key) if request_key else activities.document()
+             activity_id = activity_ref.id
+             activity_data = {
+                 'id': activity_id,
+                 'user_id': user_id,
+                 'type': 'profile_update',
+                 'updated_fields': list(update_data.keys()),
+                 'updated_at': firestore.SERVER_TIMESTAMP,
+                 'updated_by': UPDATED_BY # Or identify source if needed
+             }
+             batch.set(activity_ref, activity_data)
+        try:
+            batch.commit()
+        except NotFound:
+            # update() requires the document to exist, so nothing in the batch was written
+            logger.error(f"User {user_id} not found")
+            return (orjson.dumps({'error': 'User not found'}), 404, headers)
+        if activity_id:
+             logger.info(f"Created activity log entry {activity_id} for user {user_id}")
+
+        # If notification time was updated, schedule a notification
+        scheduling_task_name = None
+        scheduling_failed = False
+        
+        if notification_updated:
+            logger.info("Notification preferences were updated, scheduling next notification")
             # Schedule the next notification
             try:
                 is_one_time = True if next_notification_time_input else False
                 logger.info(f"Scheduling new notification for user {user_id}: is_one_time={is_one_time}, force_today={force_today}")
-                task_response = schedule_notification_task(
+                scheduling_task_name = schedule_notification_task(
                     user_id,
-                    next_time.isoformat(),
+                    next_time_utc_str,
+                    scheduled_notification_id,
                     is_one_time=is_one_time,
-                    force_today=force_today
+                    force_today=force_today,
+                    cancel_existing=True,
+                    request_key=request_key,
+                    schedule_id=scheduled_notification_id
                 )
-                if task_response and 'notification_id' in task_response:
-                    scheduled_task_id = task_response['notification_id']
-                    logger.info(f"Scheduled notification with ID: {scheduled_task_id}")
-            except Exception as e:
-                logger.error(f"Error scheduling new notification: {str(e)}")
-                logger.error(traceback.format_exc())
+            except Exception:
+                logger.exception("Error scheduling new notification")
+                scheduling_failed = True
         elif next_notification_time_input:
             logger.info("One-time notification time was set, scheduling notification")
-            # Extract the one-time notification time from update_data
-            next_time = update_data.get('next_notification_time')
-            
-            # Cancel any existing scheduled notifications
-            try:
-                logger.info(f"Cancelling existing scheduled notifications for user {user_id}")
-                cancel_existing_scheduled_notifications(user_id)
-            except Exception as e:
-                logger.error(f"Error cancelling existing notifications: {str(e)}")
-                logger.error(traceback.format_exc())
+            # Reuse the one-time notification time already formatted for update_data
+            next_time_utc_str = update_data['next_notification_time_utc']
             
             # Schedule the one-time notification
             try:
                 logger.info(f"Scheduling one-time notification for user {user_id}")
-                task_response = schedule_notification_task(
+                scheduling_task_name = schedule_notification_task(
                     user_id,
-                    next_time.isoformat(),
+                    next_time_utc_str,
+                    scheduled_notification_id,
                     is_one_time=True,
-                    force_today=force_today
+                    force_today=force_today,
+                    cancel_existing=True,
+                    request_key=request_key
                 )
-                if task_response and 'notification_id' in task_response:
-                    scheduled_task_id = task_response['notification_id']
-                    logger.info(f"Scheduled one-time notification with ID: {scheduled_task_id}")
-            except Exception as e:
-                logger.error(f"Error scheduling one-time notification: {str(e)}")
-                logger.error(traceback.format_exc())
+            except Exception:
+                logger.exception("Error scheduling one-time notification")
+                scheduling_failed = True
+        
+        if scheduling_failed:
+            # The update is committed, but nothing replaces the user's queued notifications;
+            # report it so the client retries instead of assuming the new time is scheduled
+            return (orjson.dumps({
+                'error': 'User information updated but the notification could not be scheduled',
+                'updated_fields': list(update_data.keys())
+            }), 500, headers)
         
         response_data = {
             'status': 'success',
             'message': 'User information updated successfully',
-            # Only include updated_values if actual profile fields were updated
-            'updated_values': serialize_firestore_data({k:v for k,v in update_data.items() if k != 'last_analysis_request_timestamp'}) if any(k != 'last_analysis_request_timestamp' for k in update_data) else {}
+            # Field names only, like the activity log; values are not echoed back
+            'updated_fields': list(update_data.keys())
         }
         
-        if scheduled_task_id:
-            response_data['scheduled_notification_id'] = scheduled_task_id
+        if scheduling_task_name:
+            response_data['scheduled_notification_id'] = scheduled_notification_id
+            response_data['scheduling_task_name'] = scheduling_task_name
             
-        return (json.dumps(response_data), 200, headers)
+        return (orjson.dumps(response_data), 200, headers)
             
-    except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error(f"Error updating user information: {str(e)}\n{error_details}")
-        return (json.dumps({'error': str(e)}), 500, headers)
+    except Exception:
+        # logger.exception attaches the traceback to the record; clients only get a generic message
+        logger.exception("Error updating user information")
+        return (orjson.dumps({'error': 'Internal error updating user information'}), 500, headers)
+
+@functools.lru_cache(maxsize=64)
+def timezone_for_offset(offset_hours):
+    """Fixed-offset timezone for a UTC offset in hours, shared by every request with that offset."""
+    return timezone(timedelta(hours=offset_hours))
+
+def parse_hour_minute(value):
+    """Parse an 'HH:MM' string into (hour, minute), or return None if it is not a valid time."""
+    match = TIME_PATTERN.fullmatch(value) if isinstance(value, str) else None
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
 
-def extract_timezone_offset(user_data):
-    """Extract timezone offset from user data consistently."""
+def extract_timezone_offset(user_data, default=0):
+    """Extract timezone offset from user data consistently, returning default if none is found."""
     # First, check for the explicit timezone field (which appears in your user document)
-    print("🕒 extract_timezone_offset: Checking for timezone field")
-    print(f"User data: {user_data}")
     if 'timezone' in user_data:
         try:
             timezone_value = user_data.get('timezone')
@@ -376,104 +454,68 @@ def extract_timezone_offset(user_data):
                     logger.info(f"Extracted timezone offset {timezone_offset} from {field}")
                     break
     
-    # Default to UTC if still not found
+    # Fall back to the default (UTC unless the caller asks otherwise) if still not found
     if timezone_offset is None:
-        logger.warning("Could not determine user timezone, defaulting to UTC")
-        timezone_offset = 0
+        logger.warning(f"Could not determine user timezone, using default {default}")
+        timezone_offset = default
         
     return timezone_offset
 
-def cancel_existing_scheduled_notifications(user_id):
-    """Cancel any existing scheduled notifications for the user."""
-    logger.info(f"Cancelling existing scheduled notifications for user {user_id}")
-    
-    # Get notifications with status 'scheduled'
-    notifications = db.collection('notifications') \
-        .where('user_id', '==', user_id) \
-        .where('status', '==', 'scheduled') \
-        .stream()
-    
-    cancelled_count = 0
-    for notif in notifications:
-        notif_data = notif.to_dict()
-        task_name = notif_data.get('task_name')
-        
-        # Update notification status
-        db.collection('notifications').document(notif.id).update({
-            'status': 'cancelled',
-            'updated_at': firestore.SERVER_TIMESTAMP,
-            'cancelled_reason': 'User updated notification preferences'
-        })
-        logger.info(f"Cancelled notification {notif.id}")
-        
-        # If we have task_name, try to delete the Cloud Task
-        if task_name:
-            try:
-                # We could use the Cloud Tasks client here to delete the task
-                from google.cloud import tasks_v2
-                client = tasks_v2.CloudTasksClient()
-                client.delete_task(name=task_name)
-                logger.info(f"Deleted Cloud Task: {task_name}")
-            except Exception as e:
-                logger.error(f"Error deleting Cloud Task {task_name}: {str(e)}")
-                logger.error(traceback.format_exc())
-        
-        cancelled_count += 1
+def schedule_notification_task(user_id, scheduled_time, notification_id, is_one_time=False, custom_title=None, custom_body=None, force_today=False, cancel_existing=False, request_key=None, schedule_id=None):
+    """
+    Queue a Cloud Task that calls the schedule_notification Cloud Function.
     
-    logger.info(f"Cancelled {cancelled_count} notifications for user {user_id}")
-    return cancelled_count
-
-def schedule_notification_task(user_id, scheduled_time, is_one_time=False, custom_title=None, custom_body=None, force_today=False):
-    """Call the schedule_notification Cloud Function."""
+    With a request_key the task gets a deterministic name, so Cloud Tasks rejects
+    the duplicate when a retried request tries to queue it again. The caller fixes
+    notification_id, so queue retries of the task reuse one notification, and passes
+    schedule_id for recurring notifications so a superseded task is dropped.
+    Returns the task name.
+    """
     logger.info(f"Scheduling notification for user {user_id}: is_one_time={is_one_time}, force_today={force_today}")
     
-    # Get the GCP project ID
-    project_id = 'pepmvp'  # Your GCP project ID
-    
     # Prepare the request payload
     payload = {
+        'notification_id': notification_id,
         'user_id': user_id,
         'scheduled_time': scheduled_time,
         'is_one_time': is_one_time,
-        'force_today': force_today
+        'force_today': force_today,
+        # schedule_notification cancels the user's other scheduled notifications first
+        'cancel_existing': cancel_existing
     }
     
+    if schedule_id:
+        payload['schedule_id'] = schedule_id
+    
     if custom_title:
         payload['custom_title'] = custom_title
     
     if custom_body:
         payload['custom_body'] = custom_body
     
-    # URL of the schedule_notification Cloud Function
-    url = f"https://us-central1-{project_id}.cloudfunctions.net/schedule_notification"
-    
     # Log the payload for debugging
-    logger.info(f"Sending notification schedule request with payload: {json.dumps(payload)}")
-    
-    # Make the HTTP request with a timeout
-    response = requests.post(url, json=payload, timeout=30)
+    logger.info(f"Queueing notification schedule request with payload: {orjson.dumps(payload).decode()}")
     
-    # Process the response
-    logger.info(f"Schedule API response status: {response.status_code}")
+    task = {
+        'http_request': {
+            'url': SCHEDULE_NOTIFICATION_URL,
+            'headers': {'Content-Type': 'application/json'},
+            'body': orjson.dumps(payload)
+        }
+    }
+    if request_key:
+        task['name'] = f"{SCHEDULE_QUEUE_PATH}/tasks/schedule-{request_key}"
     
-    if response.status_code == 200:
-        try:
-            response_data = response.json()
-            logger.info(f"Schedule API success: {json.dumps(response_data)}")
-            return response_data
-        except json.JSONDecodeError:
-            error_message = f"Failed to parse API response as JSON: {response.text}"
-            logger.error(error_message)
-            raise Exception(error_message)
-    else:
-        error_message = f"Failed to schedule notification: HTTP {response.status_code}: {response.text}"
-        logger.error(error_message)
-        try:
-            error_json = response.json()
-            logger.error(f"Error details: {json.dumps(error_json)}")
-        except:
-            logger.error(f"Could not parse error response as JSON")
-        raise Exception(error_message)
+    try:
+        response = get_tasks_client().create_task(request={
+            'parent': SCHEDULE_QUEUE_PATH,
+            'task': task
+        }, timeout=SCHEDULE_TASK_TIMEOUT_SECONDS)
+    except AlreadyExists:
+        logger.info(f"Scheduling task {task['name']} already queued by an earlier attempt of this request")
+        return task['name']
+    logger.info(f"Queued schedule_notification task: {response.name}")
+    return response.name
 
 def calculate_next_notification_time(hour, minute, user_timezone_offset, current_time=None):
     """
@@ -488,47 +530,17 @@ def calculate_next_notification_time(hour, minute, user_timezone_offset, current
     Returns:
         next_time: The next notification time as a datetime object in UTC
     """
-    # Use provided time or current UTC time
-    now = current_time or datetime.now(timezone.utc)
-    logger.info(f"Current time (UTC): {now.isoformat()}")
+    # Whole seconds keep the day arithmetic exact; the target always has zero seconds
+    now = (current_time or datetime.now(timezone.utc)).astimezone(timezone.utc).replace(microsecond=0)
     
-    # First, convert the current UTC time to the user's local time
-    user_local_time = now.astimezone(timezone(timedelta(hours=user_timezone_offset)))
-    logger.info(f"Current time in user's timezone (UTC{'+' if user_timezone_offset >= 0 else ''}{user_timezone_offset}): {user_local_time.isoformat()}")
+    # Seconds until the target time of day in the user's timezone; a target that
+    # has already passed (or is right now) moves to the same time tomorrow
+    local_seconds = (int(now.timestamp()) + round(user_timezone_offset * 3600)) % 86400
+    seconds_until = hour * 3600 + minute * 60 - local_seconds
+    if seconds_until <= 0:
+        seconds_until += 86400
     
-    # Create target time in user's local timezone for today
-    user_target_time = user_local_time.replace(hour=hour, minute=minute, second=0, microsecond=0)
-    logger.info(f"Target time in user's timezone: {user_target_time.isoformat()}")
-    
-    # If target time has passed in user's timezone, add a day
-    if user_target_time <= user_local_time:
-        user_target_time += timedelta(days=1)
-        logger.info(f"Target time already passed in user's timezone, scheduling for tomorrow: {user_target_time.isoformat()}")
-        
-    # Convert the final time back to UTC for storage and scheduling
-    target_time_utc = user_target_time.astimezone(timezone.utc)
-    logger.info(f"Final notification time (UTC): {target_time_utc.isoformat()}")
+    target_time_utc = now + timedelta(seconds=seconds_until)
+    logger.info(f"Next notification time for local {hour:02d}:{minute:02d} (UTC{'+' if user_timezone_offset >= 0 else ''}{user_timezone_offset}): {target_time_utc.isoformat()} UTC")
     
     return target_time_utc
-
-# Helper function to serialize Firestore data for JSON
-def serialize_firestore_data(data):
-    """Helper function to serialize Firestore data for JSON, converting datetimes."""
-    if isinstance(data, dict):
-        # Recursively serialize dictionary values
-        return {k: serialize_firestore_data(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        # Recursively serialize list items
-        return [serialize_firestore_data(item) for item in data]
-    elif isinstance(data, datetime):
-        # Convert datetime objects to ISO 8601 string format
-        return data.isoformat()
-    elif hasattr(data, 'datetime') and isinstance(getattr(data, 'datetime', None), datetime):
-         # Handle Firestore Timestamp objects
-         return data.datetime.isoformat()
-    # Skip Firestore SERVER_TIMESTAMP placeholder or other non-serializable types
-    elif isinstance(data, type(firestore.SERVER_TIMESTAMP)):
-         return None
-    else:
-        # Return other basic types as is
-        return data
\ No newline at end of file
@@ -20,6 +20,14 @@ except Exception:
     GCP_ENABLED = False
     logger.warning("GCP Cloud Logging could not be initialized. Using standard logging.")
 
+def json_default(value):
+    """Serialize values the json module can't handle, such as Firestore timestamps."""
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'datetime'):
+        return value.datetime.isoformat()
+    return str(value)
+
 def generate_request_id():
     """Generate a unique request ID for tracing."""
     return str(uuid.uuid4())
@@ -31,11 +39,20 @@ class StructuredLogger:
         self.service_name = service_name
         self.request_id = None
         self.user_id = None
+        self.context = {}
     
     def set_context(self, request_id=None, user_id=None):
         """Set the current request context."""
         self.request_id = request_id or generate_request_id()
         self.user_id = user_id
+        self.context = {}
+        return self
+    
+    def bind(self, user_id=None, **fields):
+        """Attach fields to every log entry for the rest of the current request, keeping its request_id."""
+        if user_id is not None:
+            self.user_id = user_id
+        self.context.update(fields)
         return self
     
     def _format_log(self, message, additional_data=None):
@@ -54,6 +71,9 @@ class StructuredLogger:
         
         if self.user_id:
             log_data["user_id"] = self.user_id
+        
+        if self.context:
+            log_data.update(self.context)
             
         if additional_data:
             # Sanitize additional data to remove sensitive info
@@ -81,33 +101,37 @@ class StructuredLogger:
         return sanitized
     
     def debug(self, message, data=None):
-        """Log a debug message."""
+        """Log a debug message (skips formatting entirely when DEBUG is disabled)."""
+        if not logger.isEnabledFor(logging.DEBUG):
+            return None
         log_data = self._format_log(message, data)
-        logger.debug(json.dumps(log_data))
+        logger.debug(json.dumps(log_data, default=json_default))
         return log_data
     
     def info(self, message, data=None):
-        """Log an info message."""
+        """Log an info message (skips formatting entirely when INFO is disabled)."""
+        if not logger.isEnabledFor(logging.INFO):
+            return None
         log_data = self._format_log(message, data)
-        logger.info(json.dumps(log_data))
+        logger.info(json.dumps(log_data, default=json_default))
         return log_data
     
     def warning(self, message, data=None):
         """Log a warning message."""
         log_data = self._format_log(message, data)
-        logger.warning(json.dumps(log_data))
+        logger.warning(json.dumps(log_data, default=json_default))
         return log_data
     
     def error(self, message, data=None, exc_info=None):
         """Log an error message."""
         log_data = self._format_log(message, data)
-        logger.error(json.dumps(log_data), exc_info=exc_info)
+        logger.error(json.dumps(log_data, default=json_default), exc_info=exc_info)
         return log_data
     
     def critical(self, message, data=None, exc_info=None):
         """Log a critical message."""
         log_data = self._format_log(message, data)
-        logger.critical(json.dumps(log_data), exc_info=exc_info)
+        logger.critical(json.dumps(log_data, default=json_default), exc_info=exc_info)
         return log_data
 
 def create_logger(service_name):